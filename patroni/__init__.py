@@ -11,7 +11,7 @@ class Patroni(object):
 
     def __init__(self):
         from patroni.api import RestApiServer
-        from patroni.config import Config
+        from patroni.config import Config, check_libyaml
         from patroni.dcs import get_dcs
         from patroni.ha import Ha
         from patroni.log import PatroniLogger
@@ -26,6 +26,7 @@ class Patroni(object):
         self.logger = PatroniLogger()
         self.config = Config()
         self.logger.reload_config(self.config.get('log', {}))
+        check_libyaml()
         self.dcs = get_dcs(self.config)
         self.watchdog = Watchdog(self.config)
         self.load_dynamic_configuration()
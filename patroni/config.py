@@ -1,20 +1,83 @@
 import json
 import logging
 import os
-import shutil
+import re
 import sys
 import tempfile
 import yaml
 
-from collections import defaultdict
 from copy import deepcopy
 from patroni.dcs import ClusterConfig
-from patroni.postgresql.config import ConfigHandler
 from patroni.utils import deep_compare, parse_bool, parse_int, patch_config
 from requests.structures import CaseInsensitiveDict
 
+
+def _stdlib_json_dumps(obj):
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+try:
+    import orjson
+
+    def _json_dumps(obj):
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:  # e.g. integers wider than 64 bits, which are supported by json
+            return _stdlib_json_dumps(obj)
+
+    _json_loads = orjson.loads
+except ImportError:  # orjson is optional, fall back to the slower stdlib implementation
+    _json_dumps = _stdlib_json_dumps
+
+    def _json_loads(data):
+        return json.loads(data.decode('utf-8'))
+
+try:
+    _replace_file = os.replace
+except AttributeError:  # Python 2.7, on POSIX os.rename atomically replaces the destination
+    _replace_file = os.rename
+
+try:
+    from yaml import CSafeLoader as _YamlSafeLoader
+except ImportError:  # PyYAML was built without libyaml bindings
+    from yaml import SafeLoader as _YamlSafeLoader
+
 logger = logging.getLogger(__name__)
 
+# PATRONI_(ETCD|CONSUL|ZOOKEEPER|EXHIBITOR|...)_(HOSTS?|PORT|..), applied to names without the PATRONI_ prefix
+_DCS_ENV_RE = re.compile(r'^([^_]+)_(.+)$')
+# PATRONI_<username>_PASSWORD, applied to names without the PATRONI_ prefix
+_USER_PASSWORD_ENV_RE = re.compile(r'^(.+)_PASSWORD$')
+# list item which doesn't contain any YAML indicators, e.g. host:port or createrole
+_SIMPLE_LIST_ITEM_RE = re.compile(r'^[A-Za-z0-9_.][A-Za-z0-9_.:/-]*(?<!:)$')
+_YAML_STR_TAG = 'tag:yaml.org,2002:str'
+_yaml_resolver = yaml.resolver.Resolver()
+
+
+def _yaml_load(stream):
+    return yaml.load(stream, Loader=_YamlSafeLoader)
+
+
+def _is_simple_list_item(item):
+    """Checks that YAML would parse the item of a comma-separated list as a plain string"""
+    return bool(_SIMPLE_LIST_ITEM_RE.match(item)) and\
+        _yaml_resolver.resolve(yaml.ScalarNode, item, (True, False)) == _YAML_STR_TAG
+
+
+def check_libyaml():
+    """Warns once on the daemon startup if only the slow pure-Python YAML parser is available"""
+    if _YamlSafeLoader is yaml.SafeLoader:
+        logger.warning('PyYAML is built without libyaml support, falling back to the pure-Python YAML parser')
+
+
+def _serialize_config(config):
+    """Serialize configuration into bytes for a fast equality check, returns `None` if it is not possible"""
+    try:
+        return _json_dumps(config)
+    except Exception:
+        return None
+
+
 _AUTH_ALLOWED_PARAMETERS = (
     'username',
     'password',
@@ -25,6 +88,12 @@ _AUTH_ALLOWED_PARAMETERS = (
     'sslcrl'
 )
 
+# keys of the `postgresql` section which are node-specific and can't be set from DCS
+_PG_RESERVED = frozenset(('connect_address', 'listen', 'data_dir', 'pgpass', 'authentication'))
+
+# values propagated from the top level of the effective configuration into the `postgresql` section
+_TOP_PROMOTED = ('name', 'scope', 'retry_timeout', 'synchronous_mode', 'synchronous_mode_strict')
+
 
 class Config(object):
     """
@@ -68,17 +137,37 @@ class Config(object):
         },
         'postgresql': {
             'bin_dir': '',
-            'use_slots': True,
-            'parameters': CaseInsensitiveDict({p: v[0] for p, v in ConfigHandler.CMDLINE_OPTIONS.items()})
+            'use_slots': True
+            # 'parameters' are taken from ConfigHandler.CMDLINE_OPTIONS, see `_load_cmdline_options()`
         },
         'watchdog': {
             'mode': 'automatic',
         }
     }
+    __DEFAULT_CONFIG_BYTES = None
+    __CMDLINE_OPTIONS_VALIDATORS = None
+
+    @classmethod
+    def _load_cmdline_options(cls):
+        """Import of `ConfigHandler` pulls in the whole `patroni.postgresql` package (and psycopg2),
+        therefore it is postponed until the first `Config` object is created."""
+        if cls.__CMDLINE_OPTIONS_VALIDATORS is None:
+            from patroni.postgresql.config import ConfigHandler
+
+            parameters = {p: v[0] for p, v in ConfigHandler.CMDLINE_OPTIONS.items()}
+            # serialized defaults, `_safe_copy_dynamic_configuration()` starts every rebuild from them
+            cls.__DEFAULT_CONFIG_BYTES = _json_dumps(dict(cls.__DEFAULT_CONFIG, postgresql=dict(
+                cls.__DEFAULT_CONFIG['postgresql'], parameters=parameters)))
+            # validators of CMDLINE_OPTIONS by lowercased parameter name
+            cls.__CMDLINE_OPTIONS_VALIDATORS = {p.lower(): v[1] for p, v in ConfigHandler.CMDLINE_OPTIONS.items()}
 
     def __init__(self):
+        self._load_cmdline_options()
+
         self._modify_index = -1
         self._dynamic_configuration = {}
+        self._dynamic_config_bytes = None
+        self._config_file_stat = None
 
         self.__environment_configuration = self._build_environment_configuration()
 
@@ -88,13 +177,14 @@ class Config(object):
             self._local_configuration = self._load_config_file()
         else:
             config_env = os.environ.pop(self.PATRONI_CONFIG_VARIABLE, None)
-            self._local_configuration = config_env and yaml.safe_load(config_env) or self.__environment_configuration
+            self._local_configuration = config_env and _yaml_load(config_env) or self.__environment_configuration
             if not self._local_configuration:
                 print('Usage: {0} config.yml'.format(sys.argv[0]))
                 print('\tPatroni may also read the configuration from the {0} environment variable'.
                       format(self.PATRONI_CONFIG_VARIABLE))
                 sys.exit(1)
 
+        self._local_config_bytes = _serialize_config(self._local_configuration)
         self.__effective_configuration = self._build_effective_configuration({}, self._local_configuration)
         self._data_dir = self.__effective_configuration['postgresql']['data_dir']
         self._cache_file = os.path.join(self._data_dir, self.__CACHE_FILENAME)
@@ -105,6 +195,9 @@ class Config(object):
     def config_file(self):
         return self._config_file
 
+    def _dump_dynamic_configuration(self):
+        return _json_dumps(self._dynamic_configuration)
+
     @property
     def dynamic_configuration(self):
         return deepcopy(self._dynamic_configuration)
@@ -112,18 +205,26 @@ class Config(object):
     def check_mode(self, mode):
         return bool(parse_bool(self._dynamic_configuration.get(mode)))
 
+    def _get_config_file_stat(self):
+        st = os.stat(self._config_file)
+        # mtime could be normalized (Nix store, reproducible images, `cp -p`), but inode and ctime can't be faked
+        if hasattr(st, 'st_mtime_ns'):
+            return st.st_dev, st.st_ino, st.st_ctime_ns, st.st_mtime_ns, st.st_size
+        return st.st_dev, st.st_ino, st.st_ctime, st.st_mtime, st.st_size
+
     def _load_config_file(self):
         """Loads config.yaml from filesystem and applies some values which were set via ENV"""
+        self._config_file_stat = self._get_config_file_stat()
         with open(self._config_file) as f:
-            config = yaml.safe_load(f)
+            config = _yaml_load(f)
             patch_config(config, self.__environment_configuration)
             return config
 
     def _load_cache(self):
         if os.path.isfile(self._cache_file):
             try:
-                with open(self._cache_file) as f:
-                    self.set_dynamic_configuration(json.load(f))
+                with open(self._cache_file, 'rb') as f:
+                    self.set_dynamic_configuration(_json_loads(f.read()))
             except Exception:
                 logger.exception('Exception when loading file: %s', self._cache_file)
 
@@ -132,10 +233,13 @@ class Config(object):
             tmpfile = fd = None
             try:
                 (fd, tmpfile) = tempfile.mkstemp(prefix=self.__CACHE_FILENAME, dir=self._data_dir)
-                with os.fdopen(fd, 'w') as f:
+                with os.fdopen(fd, 'wb') as f:
                     fd = None
-                    json.dump(self.dynamic_configuration, f)
-                tmpfile = shutil.move(tmpfile, self._cache_file)
+                    f.write(self._dump_dynamic_configuration())
+                    f.flush()
+                    os.fsync(f.fileno())
+                _replace_file(tmpfile, self._cache_file)
+                tmpfile = None
                 self._cache_needs_saving = False
             except Exception:
                 logger.exception('Exception when saving file: %s', self._cache_file)
@@ -158,11 +262,20 @@ class Config(object):
             self._modify_index = configuration.modify_index
             configuration = configuration.data
 
+        # byte-identical serialized configuration is the most common case, it allows to skip deep_compare
+        config_bytes = _serialize_config(configuration)
+        if config_bytes is not None and config_bytes == self._dynamic_config_bytes:
+            return
+
         if not deep_compare(self._dynamic_configuration, configuration):
             try:
-                self.__effective_configuration = self._build_effective_configuration(configuration,
-                                                                                     self._local_configuration)
+                # effective configuration must be rebuilt only if some of the keys it is built from were changed
+                if not deep_compare(self._project_dynamic_configuration(self._dynamic_configuration),
+                                    self._project_dynamic_configuration(configuration)):
+                    self.__effective_configuration = self._build_effective_configuration(configuration,
+                                                                                         self._local_configuration)
                 self._dynamic_configuration = configuration
+                self._dynamic_config_bytes = config_bytes
                 self._cache_needs_saving = True
                 return True
             except Exception:
@@ -171,32 +284,49 @@ class Config(object):
     def reload_local_configuration(self):
         if self.config_file:
             try:
+                # don't bother reading and parsing the file if it wasn't replaced or modified since the last load
+                if self._get_config_file_stat() == self._config_file_stat:
+                    return logger.info('No local configuration items changed.')
                 configuration = self._load_config_file()
-                if not deep_compare(self._local_configuration, configuration):
+                config_bytes = _serialize_config(configuration)
+                if (config_bytes is None or config_bytes != self._local_config_bytes) and\
+                        not deep_compare(self._local_configuration, configuration):
                     new_configuration = self._build_effective_configuration(self._dynamic_configuration, configuration)
                     self._local_configuration = configuration
+                    self._local_config_bytes = config_bytes
                     self.__effective_configuration = new_configuration
                     return True
                 else:
                     logger.info('No local configuration items changed.')
             except Exception:
+                self._config_file_stat = None  # force re-read on the next attempt
                 logger.exception('Exception when reloading local configuration from %s', self.config_file)
 
-    @staticmethod
-    def _process_postgresql_parameters(parameters, is_local=False):
-        return {name: value for name, value in (parameters or {}).items()
-                if name not in ConfigHandler.CMDLINE_OPTIONS or
-                not is_local and ConfigHandler.CMDLINE_OPTIONS[name][1](value)}
+    @classmethod
+    def _process_postgresql_parameters(cls, parameters, is_local=False):
+        ret = {}
+        for name, value in (parameters.items() if parameters else ()):
+            validator = cls.__CMDLINE_OPTIONS_VALIDATORS.get(name.lower())
+            # parameters passed via command line could be changed only from DCS and only to an acceptable value
+            if validator is None or not is_local and validator(value):
+                ret[name] = value
+        return ret
+
+    @classmethod
+    def _project_dynamic_configuration(cls, dynamic_configuration):
+        """Returns only the part of `dynamic_configuration` used by `_safe_copy_dynamic_configuration`"""
+        return {name: value for name, value in dynamic_configuration.items() if name in cls.__DEFAULT_CONFIG}
 
     def _safe_copy_dynamic_configuration(self, dynamic_configuration):
-        config = deepcopy(self.__DEFAULT_CONFIG)
+        config = _json_loads(self.__DEFAULT_CONFIG_BYTES)
+        config['postgresql']['parameters'] = CaseInsensitiveDict(config['postgresql']['parameters'])
 
         for name, value in dynamic_configuration.items():
             if name == 'postgresql':
                 for name, value in (value or {}).items():
                     if name == 'parameters':
                         config['postgresql'][name].update(self._process_postgresql_parameters(value))
-                    elif name not in ('connect_address', 'listen', 'data_dir', 'pgpass', 'authentication'):
+                    elif name not in _PG_RESERVED:
                         config['postgresql'][name] = deepcopy(value)
             elif name == 'standby_cluster':
                 for name, value in (value or {}).items():
@@ -211,10 +341,17 @@ class Config(object):
 
     @staticmethod
     def _build_environment_configuration():
-        ret = defaultdict(dict)
+        ret = {}
+
+        def _sect(name):
+            return ret.setdefault(name, {})
+
+        # scan os.environ only once, variables which we have consumed are removed from it at the end
+        patroni_env = {k[8:]: v for k, v in os.environ.items() if k.startswith(Config.PATRONI_ENV_PREFIX)}
+        env_names = list(patroni_env.keys())
 
         def _popenv(name):
-            return os.environ.pop(Config.PATRONI_ENV_PREFIX + name.upper(), None)
+            return patroni_env.pop(name.upper(), None)
 
         for param in ('name', 'namespace', 'scope'):
             value = _popenv(param)
@@ -223,9 +360,9 @@ class Config(object):
 
         def _fix_log_env(name, oldname):
             value = _popenv(oldname)
-            name = Config.PATRONI_ENV_PREFIX + 'LOG_' + name.upper()
-            if value and name not in os.environ:
-                os.environ[name] = value
+            name = 'LOG_' + name.upper()
+            if value and name not in patroni_env:
+                patroni_env[name] = value
 
         for name, oldname in (('level', 'loglevel'), ('format', 'logformat'), ('dateformat', 'log_datefmt')):
             _fix_log_env(name, oldname)
@@ -234,7 +371,7 @@ class Config(object):
             for param in params:
                 value = _popenv(section + '_' + param)
                 if value:
-                    ret[section][param] = value
+                    _sect(section)[param] = value
 
         _set_section_values('restapi', ['listen', 'connect_address', 'certfile', 'keyfile', 'cafile', 'verify_client'])
         _set_section_values('ctl', ['insecure', 'cacert', 'certfile', 'keyfile'])
@@ -246,7 +383,7 @@ class Config(object):
             if not value.strip().startswith('{'):
                 value = '{{{0}}}'.format(value)
             try:
-                return yaml.safe_load(value)
+                return _yaml_load(value)
             except Exception:
                 logger.exception('Exception when parsing dict %s', value)
                 return None
@@ -255,19 +392,15 @@ class Config(object):
         if value:
             value = _parse_dict(value)
             if value:
-                ret['log']['loggers'] = value
+                _sect('log')['loggers'] = value
 
-        def _get_auth(name, params=None):
-            ret = {}
-            for param in params or _AUTH_ALLOWED_PARAMETERS[:2]:
-                value = _popenv(name + '_' + param)
-                if value:
-                    ret[param] = value
-            return ret
+        def _get_auth(name, params=_AUTH_ALLOWED_PARAMETERS[:2]):
+            values = ((param, _popenv(name + '_' + param)) for param in params)
+            return {param: value for param, value in values if value}
 
         restapi_auth = _get_auth('restapi')
         if restapi_auth:
-            ret['restapi']['authentication'] = restapi_auth
+            _sect('restapi')['authentication'] = restapi_auth
 
         authentication = {}
         for user_type in ('replication', 'superuser', 'rewind'):
@@ -276,56 +409,66 @@ class Config(object):
                 authentication[user_type] = entry
 
         if authentication:
-            ret['postgresql']['authentication'] = authentication
+            _sect('postgresql')['authentication'] = authentication
 
         def _parse_list(value):
+            # fast path for the most common case: 'host1:port1,host2:port2'
+            items = [item.strip() for item in value.split(',')]
+            if all(_is_simple_list_item(item) for item in items):
+                return items
+
             if not (value.strip().startswith('-') or '[' in value):
                 value = '[{0}]'.format(value)
             try:
-                return yaml.safe_load(value)
+                return _yaml_load(value)
             except Exception:
                 logger.exception('Exception when parsing list %s', value)
                 return None
 
-        for param in list(os.environ.keys()):
-            if param.startswith(Config.PATRONI_ENV_PREFIX):
-                # PATRONI_(ETCD|CONSUL|ZOOKEEPER|EXHIBITOR|...)_(HOSTS?|PORT|..)
-                name, suffix = (param[8:].split('_', 1) + [''])[:2]
-                if suffix in ('HOST', 'HOSTS', 'PORT', 'USE_PROXIES', 'PROTOCOL', 'SRV', 'URL', 'PROXY',
-                              'CACERT', 'CERT', 'KEY', 'VERIFY', 'TOKEN', 'CHECKS', 'DC', 'CONSISTENCY',
-                              'REGISTER_SERVICE', 'SERVICE_CHECK_INTERVAL', 'NAMESPACE', 'CONTEXT',
-                              'USE_ENDPOINTS', 'SCOPE_LABEL', 'ROLE_LABEL', 'POD_IP', 'PORTS', 'LABELS') and name:
-                    value = os.environ.pop(param)
-                    if suffix == 'PORT':
-                        value = value and parse_int(value)
-                    elif suffix in ('HOSTS', 'PORTS', 'CHECKS'):
-                        value = value and _parse_list(value)
-                    elif suffix == 'LABELS':
-                        value = _parse_dict(value)
-                    elif suffix in ('USE_PROXIES', 'REGISTER_SERVICE'):
-                        value = parse_bool(value)
-                    if value:
-                        ret[name.lower()][suffix.lower()] = value
+        for param in list(patroni_env.keys()):
+            match = _DCS_ENV_RE.match(param)
+            if not match:
+                continue
+            name, suffix = match.groups()
+            if suffix in ('HOST', 'HOSTS', 'PORT', 'USE_PROXIES', 'PROTOCOL', 'SRV', 'URL', 'PROXY',
+                          'CACERT', 'CERT', 'KEY', 'VERIFY', 'TOKEN', 'CHECKS', 'DC', 'CONSISTENCY',
+                          'REGISTER_SERVICE', 'SERVICE_CHECK_INTERVAL', 'NAMESPACE', 'CONTEXT',
+                          'USE_ENDPOINTS', 'SCOPE_LABEL', 'ROLE_LABEL', 'POD_IP', 'PORTS', 'LABELS'):
+                value = patroni_env.pop(param)
+                if suffix == 'PORT':
+                    value = value and parse_int(value)
+                elif suffix in ('HOSTS', 'PORTS', 'CHECKS'):
+                    value = value and _parse_list(value)
+                elif suffix == 'LABELS':
+                    value = _parse_dict(value)
+                elif suffix in ('USE_PROXIES', 'REGISTER_SERVICE'):
+                    value = parse_bool(value)
+                if value:
+                    _sect(name.lower())[suffix.lower()] = value
         if 'etcd' in ret:
             ret['etcd'].update(_get_auth('etcd'))
 
         users = {}
-        for param in list(os.environ.keys()):
-            if param.startswith(Config.PATRONI_ENV_PREFIX):
-                name, suffix = (param[8:].rsplit('_', 1) + [''])[:2]
-                # PATRONI_<username>_PASSWORD=<password>, PATRONI_<username>_OPTIONS=<option1,option2,...>
-                # CREATE USER "<username>" WITH <OPTIONS> PASSWORD '<password>'
-                if name and suffix == 'PASSWORD':
-                    password = os.environ.pop(param)
-                    if password:
-                        users[name] = {'password': password}
-                        options = os.environ.pop(param[:-9] + '_OPTIONS', None)
-                        options = options and _parse_list(options)
-                        if options:
-                            users[name]['options'] = options
+        for param in list(patroni_env.keys()):
+            # PATRONI_<username>_PASSWORD=<password>, PATRONI_<username>_OPTIONS=<option1,option2,...>
+            # CREATE USER "<username>" WITH <OPTIONS> PASSWORD '<password>'
+            match = _USER_PASSWORD_ENV_RE.match(param)
+            if not match:
+                continue
+            name = match.group(1)
+            password = patroni_env.pop(param)
+            if password:
+                users[name] = {'password': password}
+                options = patroni_env.pop(name + '_OPTIONS', None)
+                options = options and _parse_list(options)
+                if options:
+                    users[name]['options'] = options
         if users:
-            ret['bootstrap']['users'] = users
+            _sect('bootstrap')['users'] = users
 
+        for name in env_names:
+            if name not in patroni_env:
+                del os.environ[Config.PATRONI_ENV_PREFIX + name]
         return ret
 
     def _build_effective_configuration(self, dynamic_configuration, local_configuration):
@@ -369,15 +512,7 @@ class Config(object):
         if 'name' not in config and 'name' in pg_config:
             config['name'] = pg_config['name']
 
-        updated_fields = (
-            'name',
-            'scope',
-            'retry_timeout',
-            'synchronous_mode',
-            'synchronous_mode_strict',
-        )
-
-        pg_config.update({p: config[p] for p in updated_fields if p in config})
+        pg_config.update({p: config[p] for p in _TOP_PROMOTED if p in config})
 
         return config
 
@@ -1,16 +1,18 @@
 import os
+import shutil
 import sys
+import tempfile
 import unittest
+import yaml
 
 from mock import MagicMock, Mock, patch
-from patroni.config import Config
+from patroni.config import Config, check_libyaml, _json_dumps
 from six.moves import builtins
 
 
 class TestConfig(unittest.TestCase):
 
     @patch('os.path.isfile', Mock(return_value=True))
-    @patch('json.load', Mock(side_effect=Exception))
     @patch.object(builtins, 'open', MagicMock())
     def setUp(self):
         sys.argv = ['patroni.py']
@@ -20,10 +22,46 @@ class TestConfig(unittest.TestCase):
     def test_no_config(self):
         self.assertRaises(SystemExit, Config)
 
+    @patch('patroni.config.logger.warning')
+    def test_check_libyaml(self, mock_warning):
+        with patch('patroni.config._YamlSafeLoader', yaml.SafeLoader):
+            os.environ[Config.PATRONI_CONFIG_VARIABLE] = 'restapi: {}\npostgresql: {data_dir: foo}'
+            Config()
+            mock_warning.assert_not_called()
+            check_libyaml()
+            mock_warning.assert_called_once()
+
+    def test_reload_swapped_config_file(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            link = os.path.join(tmpdir, 'config.yml')
+            for name, ttl in (('a.yml', 30), ('b.yml', 40)):
+                with open(os.path.join(tmpdir, name), 'w') as f:
+                    f.write('restapi: {{}}\npostgresql: {{data_dir: foo}}\n'
+                            'bootstrap: {{dcs: {{ttl: {0}}}}}\n'.format(ttl))
+                os.utime(f.name, (1, 1))
+            os.symlink('a.yml', link)
+            sys.argv = ['patroni.py', link]
+            config = Config()
+            os.remove(link)
+            os.symlink('b.yml', link)
+            self.assertTrue(config.reload_local_configuration())
+            self.assertEqual(config['bootstrap']['dcs']['ttl'], 40)
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_set_dynamic_configuration(self):
         with patch.object(Config, '_build_effective_configuration', Mock(side_effect=Exception)):
-            self.assertIsNone(self.config.set_dynamic_configuration({'foo': 'bar'}))
+            self.assertIsNone(self.config.set_dynamic_configuration({'ttl': 60}))
         self.assertTrue(self.config.set_dynamic_configuration({'synchronous_mode': True, 'standby_cluster': {}}))
+        self.assertIsNone(self.config.set_dynamic_configuration({'synchronous_mode': True, 'standby_cluster': {}}))
+        self.assertTrue(self.config.set_dynamic_configuration({'synchronous_mode': True, 'foo': object()}))
+        self.assertTrue(self.config.set_dynamic_configuration({'synchronous_mode': True, 'foo': (1, 2)}))
+        self.assertEqual(self.config.dynamic_configuration['foo'], (1, 2))
+        with patch.object(Config, '_build_effective_configuration') as mock_build:
+            self.assertTrue(self.config.set_dynamic_configuration({'synchronous_mode': True, 'pause': True}))
+            mock_build.assert_not_called()
+        self.assertTrue(self.config.check_mode('pause'))
 
     def test_reload_local_configuration(self):
         os.environ.update({
@@ -64,22 +102,37 @@ class TestConfig(unittest.TestCase):
             'PATRONI_REPLICATION_USERNAME': 'replicator',
             'PATRONI_REPLICATION_PASSWORD': 'rep-pass',
             'PATRONI_admin_PASSWORD': 'admin',
-            'PATRONI_admin_OPTIONS': 'createrole,createdb'
+            'PATRONI_admin_OPTIONS': 'createrole,createdb',
+            'PATRONI_UNKNOWN_VARIABLE': 'foo'
         })
-        sys.argv = ['patroni.py', 'postgres0.yml']
-        config = Config()
-        with patch.object(Config, '_load_config_file', Mock(return_value={'restapi': {}})):
-            with patch.object(Config, '_build_effective_configuration', Mock(side_effect=Exception)):
-                config.reload_local_configuration()
-            self.assertTrue(config.reload_local_configuration())
-            self.assertIsNone(config.reload_local_configuration())
+        tmpdir = tempfile.mkdtemp()
+        try:
+            config_file = os.path.join(tmpdir, 'postgres0.yml')
+            shutil.copy('postgres0.yml', config_file)
+            sys.argv = ['patroni.py', config_file]
+            config = Config()
+            self.assertNotIn('PATRONI_NAME', os.environ)
+            self.assertEqual(os.environ.pop('PATRONI_UNKNOWN_VARIABLE'), 'foo')
+            with patch.object(Config, '_load_config_file') as mock_load:
+                self.assertIsNone(config.reload_local_configuration())
+                mock_load.assert_not_called()
+            with open(config_file, 'a') as f:
+                f.write('\n# modified\n')
+            with patch.object(Config, '_load_config_file', Mock(return_value={'restapi': {}})):
+                with patch.object(Config, '_build_effective_configuration', Mock(side_effect=Exception)):
+                    config.reload_local_configuration()
+                self.assertTrue(config.reload_local_configuration())
+                self.assertIsNone(config.reload_local_configuration())
+        finally:
+            shutil.rmtree(tmpdir)
 
     @patch('tempfile.mkstemp', Mock(return_value=[3000, 'blabla']))
     @patch('os.path.exists', Mock(return_value=True))
     @patch('os.remove', Mock(side_effect=IOError))
     @patch('os.close', Mock(side_effect=IOError))
-    @patch('shutil.move', Mock(return_value=None))
-    @patch('json.dump', Mock())
+    @patch('os.fsync', Mock())
+    @patch('patroni.config._replace_file', Mock())
+    @patch('patroni.config._json_dumps', Mock(return_value=b'{}'))
     def test_save_cache(self):
         self.config.set_dynamic_configuration({'ttl': 30, 'postgresql': {'foo': 'bar'}})
         with patch('os.fdopen', Mock(side_effect=IOError)):
@@ -87,6 +140,19 @@ class TestConfig(unittest.TestCase):
         with patch('os.fdopen', MagicMock()):
             self.config.save_cache()
 
+    def test_postgresql_parameters(self):
+        self.config.set_dynamic_configuration({'postgresql': {'parameters': {'max_connections': 10, 'Port': 5433,
+                                                                             'MAX_WAL_SENDERS': 20, 'foo': 'bar'}}})
+        parameters = self.config['postgresql']['parameters']
+        self.assertEqual(parameters['max_connections'], 100)
+        self.assertIsNone(parameters['port'])
+        self.assertEqual(parameters['max_wal_senders'], 20)
+        self.assertEqual(parameters['foo'], 'bar')
+
+    def test_json_dumps(self):
+        self.assertEqual(_json_dumps({1: 2}), b'{"1":2}')
+        self.assertEqual(_json_dumps({'a': 2 ** 70}), b'{"a":1180591620717411303424}')
+
     def test_standby_cluster_parameters(self):
         dynamic_configuration = {
             'standby_cluster': {